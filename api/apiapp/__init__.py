@@ -1,11 +1,30 @@
-from flask import Flask
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Parses and serializes JSON with orjson instead of the standard library's json module.
+    Types orjson cannot handle fall back to Flask's default conversions.
+    """
+    def loads(self, s: str | bytes, **kwargs):
+        return orjson.loads(s)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def response(self, *args, **kwargs) -> Response:
+        # orjson already produces bytes, so skip the round-trip through str.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
 
 def create_app() -> Flask:
     """
     Creates an application instance (for use by mod_wsgi)
     """
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     CORS(app)
 
     from . import auth, db, event, location, research, recommend
@@ -1,11 +1,89 @@
 from flask import Blueprint, request, g, abort, Response
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 from werkzeug.exceptions import Unauthorized
+from functools import wraps
+from time import monotonic
+import hashlib
+import hmac
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import psycopg
 import re
+import secrets
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
+_USERNAME_RE = re.compile(r"^([a-z0-9\-]){1,31}$", re.IGNORECASE)
+_PASSWORD_RE = re.compile(r"^(?=.*\d)(?=.*[A-Z])(?=.*[a-z])(?=.*[^0-9A-z])[ -~]{8,}$")
+_EMAIL_RE = re.compile(r"^(?!.{256,})[ -?A-~]+@[A-Za-z0-9]([A-Za-z0-9\-]*[A-Za-z0-9])?(\.[A-Za-z0-9]([A-Za-z0-9\-]*[A-Za-z0-9]))*$", re.IGNORECASE)
+
+_UNAUTHORIZED_BODY = "Incorrect login supplied."
+_UNAUTHORIZED_HEADERS = (("WWW-Authenticate", "Basic realm=\"Login Required\""),)
+
+_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+_LOGIN_CACHE_TTL = 60
+_LOGIN_CACHE_SIZE = 1024
+_login_cache_secret = secrets.token_bytes(32)
+_login_cache: dict[tuple[str, bytes], tuple[int, float]] = {}
+
+def hash_password(password: str) -> str:
+    """
+    Hashes the given password with Argon2id.
+    """
+    return _hasher.hash(password)
+
+def check_password(passwordhash: str, password: str) -> bool:
+    """
+    Checks the given password against a stored hash.
+
+    Hashes created by Werkzeug before the switch to Argon2 are still accepted.
+    """
+    if not passwordhash.startswith("$argon2"):
+        return check_password_hash(passwordhash, password)
+    try:
+        return _hasher.verify(passwordhash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(passwordhash: str) -> bool:
+    """
+    Returns whether the given stored hash should be replaced with one using the current algorithm and parameters.
+    """
+    return not passwordhash.startswith("$argon2") or _hasher.check_needs_rehash(passwordhash)
+
+def login_cache_key(username: str, password: str) -> tuple[str, bytes]:
+    """
+    Returns the login cache key for the given credentials.
+
+    The password is keyed with a per-process secret so the cache never holds anything that can be brute-forced offline.
+    """
+    return (username, hmac.new(_login_cache_secret, password.encode(), hashlib.sha256).digest())
+
+def get_cached_login(key: tuple[str, bytes]) -> int | None:
+    """
+    Returns the user ID for a recently verified login, or None if it is not cached or has expired.
+    """
+    entry = _login_cache.get(key)
+    if entry is None:
+        return None
+    userid, expires = entry
+    if expires < monotonic():
+        _login_cache.pop(key, None)
+        return None
+    return userid
+
+def cache_login(key: tuple[str, bytes], userid: int) -> None:
+    """
+    Remembers a verified login for `_LOGIN_CACHE_TTL` seconds, evicting the oldest entry if the cache is full.
+    """
+    if len(_login_cache) >= _LOGIN_CACHE_SIZE:
+        try:
+            _login_cache.pop(next(iter(_login_cache)))
+        except (StopIteration, KeyError, RuntimeError):
+            pass
+    _login_cache[key] = (userid, monotonic() + _LOGIN_CACHE_TTL)
+
 
 def authenticate(func):
     """
@@ -13,32 +91,75 @@ def authenticate(func):
     On failure, returns a 401 status code.
     On success, sets `g.userid` to the authenticated user's ID.
     """
+    @wraps(func)
     def inner(*args, **kwargs):
-        if request.authorization is None or request.authorization.type != "basic":
-            abort(401)
-        username = request.authorization.parameters["username"].lower()
-        password = request.authorization.parameters["password"]
+        auth = request.authorization
+        if auth is None or auth.type != "basic":
+            return unauthorized()
+        username = auth.username.lower()
+        password = auth.password
+        if len(username) > 64 or len(password) > 1024:
+            return unauthorized()
+
+        key = login_cache_key(username, password)
+        g.userid = get_cached_login(key)
+        if g.userid is not None:
+            return func(*args, **kwargs)
         
         assert isinstance(g.conn, psycopg.Connection)
         with g.conn.cursor() as cur:
-            cur.execute("SELECT password, id FROM users WHERE username = %s;", (username,))
-            if cur.rowcount == 0:
-                abort(401)
-            passwordhash, id = cur.fetchone()
-            if not check_password_hash(passwordhash, password):
-                abort(401)
+            cur.execute("SELECT password, id FROM users WHERE username = %s;", (username,), prepare=True)
+            row = cur.fetchone()
+            if row is None:
+                return unauthorized()
+            passwordhash, id = row
+            if not check_password(passwordhash, password):
+                return unauthorized()
+            if password_needs_rehash(passwordhash):
+                cur.execute("UPDATE users SET password = %s WHERE id = %s;", (hash_password(password), id))
             g.userid = id
+        cache_login(key, id)
         
         return func(*args, **kwargs)
-    inner.__name__ = func.__name__
     return inner
 
+def require_json_fields(**fields):
+    """
+    Requires the request body to be a JSON object containing the given fields before a request is processed.
+
+    Each keyword argument maps a field name to the type (or tuple of types) its value must have.
+    A field whose types include `type(None)` may be null or left out.
+    On failure, returns a 415 status code if the body is not JSON, or 400 if it is malformed or a field is missing or mistyped.
+    On success, passes the parsed object to the wrapped function as its first argument.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            body = request.get_json()
+            if not isinstance(body, dict):
+                abort(400)
+            for field, types in fields.items():
+                if not isinstance(body.get(field), types):
+                    abort(400)
+            return func(body, *args, **kwargs)
+        return inner
+    return decorator
+
+def unauthorized() -> Response:
+    """
+    Builds a 401 response asking the client for HTTP Basic Authentication.
+    A new Response is needed per request since after-request hooks (e.g. CORS) add headers to it.
+
+    `authenticate` returns this directly rather than going through `abort(401)` and the error handler.
+    """
+    return Response(_UNAUTHORIZED_BODY, 401, _UNAUTHORIZED_HEADERS)
+
 @bp.app_errorhandler(Unauthorized)
 def send_www_authenticate(error) -> Response:
     """
     Send a WWW-Authenticate header when a request is unauthorized.
     """
-    return Response("Incorrect login supplied.", 401, {"WWW-Authenticate": "Basic realm=\"Login Required\""})
+    return unauthorized()
 
 
 def validate_registration(username: str, password: str, email: str, displayname: str | None = None, **kwargs) -> list:
@@ -48,11 +169,11 @@ def validate_registration(username: str, password: str, email: str, displayname:
     Returns an error list if not (see docstring for `register()`).
     """
     errors = []
-    if re.compile(r"^([a-z0-9\-]){1,31}$", re.IGNORECASE).match(username) is None:
+    if len(username) > 31 or _USERNAME_RE.match(username) is None:
         errors.append({"field": "username", "description": "Username must be at most 31 characters and contain only alphanumeric characters and dashes."})
-    if re.compile(r"^(?=.*\d)(?=.*[A-Z])(?=.*[a-z])(?=.*[^0-9A-z])[ -~]{8,}$").match(password) is None:
-        errors.append({"field": "password", "description": "Password must be at least 8 characters, contain only ASCII characters, and contain at least one uppercase letter, lowercase letter, number, and special character."})
-    if re.compile(r"^(?!.{256,})[ -?A-~]+@[A-z0-9]([A-z0-9\-]*[A-z0-9])?(\.[A-z0-9]([A-z0-9\-]*[A-z0-9]))*$", re.IGNORECASE).match(email) is None:
+    if not 8 <= len(password) <= 1024 or _PASSWORD_RE.match(password) is None:
+        errors.append({"field": "password", "description": "Password must be between 8 and 1024 characters, contain only ASCII characters, and contain at least one uppercase letter, lowercase letter, number, and special character."})
+    if len(email) > 255 or _EMAIL_RE.match(email) is None:
         errors.append({"field": "email", "description": "Email is either too long or not valid."})
     if displayname is not None and len(displayname) > 63:
         errors.append({"field": "displayname", "description": "Display name cannot be more than 63 characters."})
@@ -62,6 +183,7 @@ def validate_registration(username: str, password: str, email: str, displayname:
 def check_conflicts(username: str, email: str, **kwargs) -> list:
     """
     Makes sure no other user with the given username and email exist in the database.
+    `username` and `email` must already be lowercase.
 
     Returns an error list on failure (see docstring for `register()`).
     """
@@ -69,30 +191,34 @@ def check_conflicts(username: str, email: str, **kwargs) -> list:
 
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE username = %s;", (username.lower(),))
-        if cur.rowcount != 0:
+        cur.execute("SELECT bool_or(username = %s), bool_or(email = %s) FROM users WHERE username = %s OR email = %s;",
+                    (username, email, username, email))
+        usertaken, emailtaken = cur.fetchone()
+        if usertaken:
             errors.append({"field": "username", "description": "Username is already taken."})
-        cur.execute("SELECT id FROM users WHERE email = %s;", (email.lower(),))
-        if cur.rowcount != 0:
+        if emailtaken:
             errors.append({"field": "email", "description": "Email is already taken."})
     
     return errors
 
 
-def create_user(username: str, password: str, email: str, displayname: str | None = None, **kwargs) -> int:
+def create_user(username: str, password: str, email: str, displayname: str | None = None, **kwargs) -> int | None:
     """
     Adds a user with the given name, password, and email address (and, optionally, display name) to the database.
+    `username` and `email` must already be lowercase.
 
-    Returns an error list on failure (see docstring for `register()`).
+    Returns the new user's ID, or None if the username or email is already taken.
     """
-    passwordhash = generate_password_hash(password)
+    passwordhash = hash_password(password)
 
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        cur.execute("INSERT INTO users(username, password, email) VALUES (%s, %s, %s) RETURNING id;", (username.lower(), passwordhash, email.lower()))
-        id, = cur.fetchone()
-        if displayname is not None and len(displayname) != 0:
-            cur.execute("UPDATE users SET displayname = %s WHERE id = %s;", (displayname, id))
+        cur.execute("INSERT INTO users(username, password, email, displayname) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING RETURNING id;",
+                    (username, passwordhash, email, displayname if displayname else None))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        id, = row
         return id
 
 
@@ -104,7 +230,8 @@ def send_verification_email(username: str, email: str, **kwargs) -> None:
 
 
 @bp.route("", methods=["POST"])
-def register() -> Response:
+@require_json_fields(username=str, password=str, email=str, displayname=(str, type(None)))
+def register(body: dict) -> Response:
     """
     Registers a new user into the database.
 
@@ -132,30 +259,21 @@ def register() -> Response:
     The following requirements are in place for the inputs:
         - `username` must contain no more than 31 characters.
         - `username` must contain only alphanumeric characters and hyphens ('-').
-        - `password` must contain at least 8 characters, all ASCII.
+        - `password` must contain between 8 and 1024 characters, all ASCII.
         - `password` must contain at least one uppercase letter, one lowercase letter, one digit, and one special character.
         - `email` can be no more than 255 characters and must be in valid email address form.
         - `displayname` must contain no more than 63 characters.
     """
-    if request.json is None:
-        abort(415)
-    if not isinstance(request.json, dict):
-        abort(400)
-    if "username" not in request.json or "password" not in request.json or "email" not in request.json:
-        abort(400)
-    if not isinstance(request.json["username"], str) or not isinstance(request.json["password"], str) \
-        or not isinstance(request.json["email"], str) \
-        or ("displayname" in request.json and not isinstance(request.json["displayname"], str)):
-        abort(400)
-    
-    errors = validate_registration(**request.json)
-    if not errors:
-        errors = check_conflicts(**request.json)
+    errors = validate_registration(**body)
     if errors:
         return (errors, 422)
 
-    id = create_user(**request.json)
-    #send_verification_email(**request.json)
+    username = body["username"].lower()
+    email = body["email"].lower()
+    id = create_user(username, body["password"], email, body.get("displayname"))
+    if id is None:
+        return (check_conflicts(username, email), 422)
+    #send_verification_email(**body)
     return {"id": id}
 
 @bp.route("", methods=["GET"])
@@ -178,24 +296,22 @@ def verify_email(code: int, email: str, **kwargs) -> Response:
     """
     Verifies the given email with the given code.
 
-    Returns True on success, False on failure.
+    Returns a successful response (see docstring for `verify()`) if no errors are thrown.
     """
-    success = False
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT verification FROM users WHERE email = %s;", (email.lower()))
-        if cur.rowcount == 0:
-            abort(422)
-        actualcode, = cur.fetchone()
-        if actualcode is None:
-            return ("", 204)
-        elif code != actualcode:
+        cur.execute("UPDATE users SET verification = NULL WHERE email = %s AND verification = %s RETURNING id;", (email.lower(), code))
+        if cur.fetchone() is not None:
+            return ("", 201)
+        cur.execute("SELECT verification FROM users WHERE email = %s;", (email.lower(),))
+        row = cur.fetchone()
+        if row is None or row[0] is not None:
             abort(422)
-        cur.execute("UPDATE users SET verification = NULL WHERE email = %s;", (email.lower(), code))
-        return ("", 201)
+        return ("", 204)
 
 @bp.route("/verify", methods=["PUT"])
-def verify() -> Response:
+@require_json_fields(email=str, code=int)
+def verify(body: dict) -> Response:
     """
     Verifies the given email.
 
@@ -213,12 +329,4 @@ def verify() -> Response:
     If a 200 status code is returned, the response body will contain a JSON object containing the following properties:
         - `id`: the ID of the user
     """
-    if request.json is None:
-        abort(415)
-    if not isinstance(request.json, dict):
-        abort(400)
-    if "email" not in request.json or not isinstance(request.json["email"], str):
-        abort(400)
-    if "code" not in request.json or not isinstance(request.json["code"], int):
-        abort(400)
-    return verify_email(**request.json)
\ No newline at end of file
+    return verify_email(**body)
\ No newline at end of file
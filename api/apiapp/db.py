@@ -1,57 +1,103 @@
-from flask import request, g, Blueprint, Response
+from flask import request, g, Blueprint
 import psycopg
 import psycopg.adapt
+import psycopg.pq
+from psycopg_pool import ConnectionPool
 import re
 from .location import Point
-import sys
+from functools import lru_cache
+from threading import Lock
+import struct
+
+_POINT_STRUCT = struct.Struct("!dd")
 
 class PointDumper(psycopg.adapt.Dumper):
     oid = psycopg.adapters.types["point"].oid
     def dump(self, obj: Point) -> bytes:
         return ("(%s, %s)" % (obj.lat, obj.lon)).encode()
 
+_POINT_RE = re.compile(rb"\(([^)]+),([^)]+)\)")
+
 class PointLoader(psycopg.adapt.Loader):
     def load(self, data) -> Point:
-        data_decodeable = data.tobytes() if isinstance(data, memoryview) else data
-        m = re.match(r"\(([^)]+),([^)]+)\)", data_decodeable.decode())
+        m = _POINT_RE.match(data)
         try:
-            if m is not None:
-                return Point(float(m.group(1)), float(m.group(2)))
-            else:
-                raise ValueError()
-        except:
+            return Point(float(m.group(1)), float(m.group(2)))
+        except (AttributeError, ValueError):
             raise psycopg.InterfaceError("Incorrect Point representation")
 
+class PointBinaryDumper(psycopg.adapt.Dumper):
+    format = psycopg.pq.Format.BINARY
+    oid = psycopg.adapters.types["point"].oid
+    def dump(self, obj: Point) -> bytes:
+        return _POINT_STRUCT.pack(obj.lat, obj.lon)
+
+class PointBinaryLoader(psycopg.adapt.Loader):
+    format = psycopg.pq.Format.BINARY
+    def load(self, data) -> Point:
+        return Point(*_POINT_STRUCT.unpack(data))
+
+# Registered on the global adapters map so every new connection inherits them.
+# The binary dumper is registered last so it is preferred for `%s` parameters;
+# the text loader is kept for cursors that do not request binary results.
+psycopg.adapters.register_dumper(Point, PointDumper)
+psycopg.adapters.register_dumper(Point, PointBinaryDumper)
+psycopg.adapters.register_loader("point", PointLoader)
+psycopg.adapters.register_loader("point", PointBinaryLoader)
+
 bp = Blueprint("db", __name__)
 
+_pool = None
+_pool_lock = Lock()
+
+@lru_cache(maxsize=4)
+def read_connstr(filename: str) -> str:
+    """
+    Reads the connection string from the given file.
+
+    The result is cached, so each file is only read once per process.
+    """
+    try:
+        with open(filename) as file:
+            return file.read()
+    except OSError:
+        raise RuntimeError("Could not open PSQL_CONF.")
+
+def get_pool(connstr: str) -> ConnectionPool:
+    """
+    Returns the process-wide connection pool, creating it on first use.
+
+    The pool is created lazily because the connection string is only available from the WSGI environment.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Pooled connections outlive requests, so prepare each statement on its second execution.
+                _pool = ConnectionPool(connstr, min_size=4, max_size=20, kwargs={"autocommit": True, "prepare_threshold": 1}, open=True)
+    return _pool
+
 @bp.before_app_request
 def connect() -> None:
     """
-    Connect to the database and add the handle to the app context's globals.
+    Check out a database connection from the pool and add the handle to the app context's globals.
     """
     filename = request.environ.get("PSQL_CONF")
     if filename is None:
         raise RuntimeError("Environment variable PSQL_CONF is not set.")
-    connstr = None
-    try:
-        file = open(filename)
-        connstr = file.read()
-    except OSError:
-        raise RuntimeError("Could not open PSQL_CONF.")
-    finally:
-        file.close()
     
     try:
-        g.conn = psycopg.connect(connstr, autocommit=True)
-        g.conn.adapters.register_dumper(Point, PointDumper)
-        g.conn.adapters.register_loader("point", PointLoader)
+        g.conn = get_pool(read_connstr(filename)).getconn()
     except psycopg.Error as e:
         raise RuntimeError(e.pgerror)
 
-@bp.after_app_request
-def disconnect(response: Response) -> Response:
+@bp.teardown_app_request
+def disconnect(error: BaseException | None) -> None:
     """
-    Close the database connection stored in the app context.
+    Return the database connection stored in the app context to the pool.
+
+    Runs even if the request raised, so connections are never leaked.
     """
-    g.conn.close()
-    return response
\ No newline at end of file
+    conn = g.pop("conn", None)
+    if conn is not None:
+        _pool.putconn(conn)
\ No newline at end of file
@@ -1,84 +1,311 @@
 from flask import Blueprint, request, g, abort, Response
 import psycopg
-from .auth import authenticate
+from psycopg import sql
+from .auth import authenticate, require_json_fields
 from .location import Point, get_place_info
-from time import sleep
+from .db import get_pool, read_connstr
+from psycopg_pool import ConnectionPool
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic, sleep
+import hashlib
+import re
+from functools import lru_cache
 import openai
 import openai.embeddings_utils as emb
 from datetime import datetime, timedelta
+import logging
 
 bp = Blueprint("event", __name__, url_prefix="/event")
 
+logger = logging.getLogger(__name__)
+
+_EMBEDDING_BATCH_SIZE = 64
+_EMBEDDING_BATCH_WAIT = 0.02
+_EMBEDDING_RETRIES = 4
+_EMBEDDING_RETRY_DELAY = 1
+_EMBEDDING_SWEEP_INTERVAL = 300
+_EMBEDDING_SWEEP_GRACE = timedelta(minutes=5)
+# Two-key advisory lock (a separate key space from the per-event chat locks) held by whichever process is sweeping.
+_EMBEDDING_SWEEP_LOCK = (0x656d62, 1)
+_embedding_queue: Queue = Queue()
+_embedding_worker = None
+_embedding_worker_lock = Lock()
+
+_METERS_PER_MILE = 1609.344
+_WHITESPACE_RE = re.compile(r"\s+")
+_MAX_BIGINT = 2 ** 63 - 1
+_DATE_FIELDS = ("year", "month", "day", "hour", "minute")
+# Maps the settings accepted by `event_patch()` to their columns in `events`.
+_SETTING_COLUMNS = {"displayname": "displayname", "start": "start", "end": "end", "description": "description", "location": "place"}
+
+@lru_cache(maxsize=4)
+def read_api_key(filename: str) -> str:
+    """
+    Reads the API key from the given file.
+
+    The result is cached, so each file is only read once per process.
+    """
+    with open(filename) as file:
+        return file.read().strip()
+
 @bp.before_app_request
 def setup_openai():
-    openai.api_key_path = request.environ["OPENAI_KEY_PATH"]
+    # Setting the key itself (rather than `api_key_path`) stops the client from re-reading the file on every API call.
+    openai.api_key = read_api_key(request.environ["OPENAI_KEY_PATH"])
 
 def to_datetime(json: dict, end=False):
     return datetime(int(json["year"]), int(json["month"]), int(json["day"]),
                     int(json.get("hour", 23 if end else 0)), int((59 if end else 0) if "hour" not in json else json.get("minute", 0)))
 
 def from_datetime(dt: datetime):
-    return {
-        "year": dt.year,
-        "month": dt.month,
-        "day": dt.day,
-        "hour": dt.hour,
-        "minute": dt.minute
-    }
+    # timetuple() fetches every field in one C call, instead of five attribute lookups.
+    return dict(zip(_DATE_FIELDS, dt.timetuple()[:5]))
+
+def conditional_response(response: Response) -> Response:
+    """
+    Tags the given response with an ETag of its body and answers with 304 Not Modified if the client already has it.
+    Clients must revalidate every time, since attendance can change at any moment.
+    """
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def parse_date_json(json: dict, end=False) -> datetime | None:
+    """
+    Parses a datetime object from a request body (see docstring for `create()`) in a single pass.
+    Missing times default to the start of the day, or to its end if `end` is set.
+
+    Aborts with a 400 status code if the object is malformed, and returns None if it is well-formed but not a valid date.
+    """
+    if "minute" in json and "hour" not in json:
+        abort(400)
+    try:
+        year, month, day = int(json["year"]), int(json["month"]), int(json["day"])
+        hour = int(json.get("hour", 23 if end else 0))
+        minute = int(json.get("minute", 0)) if "hour" in json else (59 if end else 0)
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    try:
+        return datetime(year, month, day, hour, minute)
+    except ValueError:
+        return None
 
-def validate_create_inputs(displayname: str, start: dict, end: dict, location: str, description: str | None = None, **kwargs):
+def validate_create_inputs(event: dict):
     """
-    Ensures the given event information is valid.
+    Ensures the given event information (an object in the format described in the docstring for `create()`,
+    with `start` and `end` already parsed by `parse_date_json()`) is valid.
 
     Returns a list of errors (see docstring for `create()`), or an empty list if no issues were found.
     """
+    displayname, start, end, location, description = event["displayname"], event["start"], event["end"], event["location"], event.get("description")
     errors = []
-    if not displayname.strip():
-        errors.append({"field": "displayname", "description": "You must enter a display name."})
     if len(displayname) > 255:
         errors.append({"field": "displayname", "description": "Display name must be less than 256 characters long."})
+    elif not displayname.strip():
+        errors.append({"field": "displayname", "description": "You must enter a display name."})
     if description is not None and len(description) > 10000:
         errors.append({"field": "description", "description": "Description must be at most 10000 characters long."})
-    startdt = enddt = None
-    try:
-        startdt = to_datetime(start)
-    except ValueError:
+    if start is None:
         errors.append({"field": "start", "description": "Not a valid date."})
-    try:
-        startdt = to_datetime(end, end=True)
-    except ValueError:
+    if end is None:
         errors.append({"field": "end", "description": "Not a valid date."})
-    if startdt is not None and enddt is not None and startdt > enddt:
+    if start is not None and end is not None and start > end:
         errors.append({"field": "end", "description": "End date cannot be earlier than start date."})
     if not errors:
         if get_place_info(location) is None:
             errors.append({"field": "location", "description": "Must be a valid Place ID."})
     return errors
 
-def create_event(displayname: str, start: dict, end: dict, location: str, description: str | None = None, **kwargs) -> int:
+def embedding_text(displayname: str, description: str | None, location: str) -> str:
+    """
+    Builds the text that is embedded to make an event searchable: its name, description, and venue name.
+    """
+    placename, _, _ = get_place_info(location)
+    return join_embedding_text(displayname, description, placename)
+
+def join_embedding_text(displayname: str, description: str | None, placename: str | None) -> str:
+    """
+    Joins an event's name, description, and venue name into the text that is embedded (see `embedding_text()`).
+    """
+    return _WHITESPACE_RE.sub(" ", " ".join(part for part in (displayname, description, placename) if part is not None)).strip()
+
+def embedding_hash(text: str) -> bytes:
+    """
+    Returns the content hash of an embedding text, stored in `events.embedding_hash` to identify what the embedding should represent.
+    """
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+def pack_embedding(embedding: list[float]) -> str:
+    """
+    Packs an embedding into the pgvector text form stored in `events.embedding`.
+    """
+    return "[" + ",".join(map(str, embedding)) + "]"
+
+@lru_cache(maxsize=1024)
+def get_query_embedding(query: str) -> str:
+    """
+    Returns the embedding of a search query, which must already be normalized (see `get_events_by_keyword()`), in the form returned by `pack_embedding()`.
+
+    Results are cached in memory and in the `query_embeddings` table, so repeated queries skip the OpenAI round-trip.
+    """
+    queryhash = embedding_hash(query)
+    assert isinstance(g.conn, psycopg.Connection)
+    with g.conn.cursor() as cur:
+        cur.execute("SELECT embedding FROM query_embeddings WHERE hash = %s;", (queryhash,))
+        row = cur.fetchone()
+        if row is not None:
+            return row[0]
+        packed = pack_embedding(emb.get_embedding(query, engine="text-embedding-ada-002", user=str(g.userid)))
+        cur.execute("INSERT INTO query_embeddings(hash, embedding) VALUES (%s, %s) ON CONFLICT DO NOTHING;", (queryhash, packed))
+    return packed
+
+def store_embeddings(pool: ConnectionPool, jobs: list[tuple[int, str, bytes]]) -> None:
+    """
+    Computes the embeddings for a batch of queued events and stores them.
+    Each job is a tuple of the event's ID, the text to embed, and its hash (see `embedding_hash()`).
+    Runs on the background worker (see `enqueue_embedding()`), so it uses its own pooled connections rather than `g.conn`.
+
+    Embeddings already stored for the same text (on any event) are reused, and the rest are requested from OpenAI in one call.
+    An embedding is only stored if the event's hash still matches, so a slow job can never overwrite the embedding of a newer edit.
+    """
+    texts = {texthash: text for _, text, texthash in jobs}
+    with pool.connection() as conn:
+        known = dict(conn.execute("SELECT DISTINCT ON (embedding_hash) embedding_hash, embedding FROM events WHERE embedding_hash = ANY(%s) AND embedding IS NOT NULL;",
+                                  (list(texts),)).fetchall())
+    missing = [texthash for texthash in texts if texthash not in known]
+    if missing:
+        known.update(zip(missing, map(pack_embedding, emb.get_embeddings([texts[texthash] for texthash in missing], engine="text-embedding-ada-002"))))
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.executemany("UPDATE events SET embedding = %s WHERE id = %s AND embedding_hash = %s;",
+                        [(known[texthash], eventid, texthash) for eventid, _, texthash in jobs])
+
+def store_embeddings_with_retry(pool: ConnectionPool, jobs: list[tuple[int, str, bytes]]) -> None:
+    """
+    Calls `store_embeddings()`, retrying up to `_EMBEDDING_RETRIES` times with exponential backoff if OpenAI or the database fails.
+    A batch that still fails is left for the next recovery sweep (see `requeue_missing_embeddings()`).
+    """
+    for attempt in range(_EMBEDDING_RETRIES):
+        try:
+            store_embeddings(pool, jobs)
+            return
+        except Exception:
+            if attempt == _EMBEDDING_RETRIES - 1:
+                logger.exception("Could not compute the embeddings for events %s; leaving them for the recovery sweep.", [job[0] for job in jobs])
+                return
+            logger.warning("Could not compute the embeddings for events %s; retrying.", [job[0] for job in jobs], exc_info=True)
+            sleep(_EMBEDDING_RETRY_DELAY * 2 ** attempt)
+
+def requeue_missing_embeddings(pool: ConnectionPool) -> None:
+    """
+    Queues every event that should have an embedding but does not, e.g. because its job failed or was lost when the process exited.
+    The stored hash is kept, so an event edited in the meantime is not overwritten (see `store_embeddings()`).
+
+    Only one process sweeps at a time, and events queued in the last `_EMBEDDING_SWEEP_GRACE` are left to the process that queued them.
+    Swept events are claimed by resetting `embedding_requested`, so no other process sweeps them again until the grace period passes.
+    """
+    try:
+        with pool.connection() as conn, conn.transaction():
+            locked, = conn.execute("SELECT pg_try_advisory_xact_lock(%s, %s);", _EMBEDDING_SWEEP_LOCK).fetchone()
+            if not locked:
+                return
+            rows = conn.execute("UPDATE events SET embedding_requested = now() FROM places "
+                                "WHERE events.place = places.id AND events.embedding IS NULL AND events.embedding_hash IS NOT NULL AND events.embedding_requested < now() - %s "
+                                "RETURNING events.id, events.displayname, events.description, places.name, events.embedding_hash;", (_EMBEDDING_SWEEP_GRACE,)).fetchall()
+    except Exception:
+        logger.exception("Could not look up events with missing embeddings.")
+        return
+    for eventid, displayname, description, placename, texthash in rows:
+        _embedding_queue.put((eventid, join_embedding_text(displayname, description, placename), texthash))
+
+def embedding_worker(pool: ConnectionPool) -> None:
+    """
+    Takes jobs off the embedding queue forever, coalescing everything queued within `_EMBEDDING_BATCH_WAIT` seconds
+    (up to `_EMBEDDING_BATCH_SIZE` jobs) into a single OpenAI request.
+
+    Every `_EMBEDDING_SWEEP_INTERVAL` seconds, starting when the worker starts, events still missing an embedding are queued again.
+    """
+    nextsweep = monotonic()
+    while True:
+        if monotonic() >= nextsweep:
+            requeue_missing_embeddings(pool)
+            nextsweep = monotonic() + _EMBEDDING_SWEEP_INTERVAL
+        try:
+            jobs = [_embedding_queue.get(timeout=max(nextsweep - monotonic(), 0))]
+        except Empty:
+            continue
+        deadline = monotonic() + _EMBEDDING_BATCH_WAIT
+        while len(jobs) < _EMBEDDING_BATCH_SIZE:
+            try:
+                jobs.append(_embedding_queue.get(timeout=max(deadline - monotonic(), 0)))
+            except Empty:
+                break
+        store_embeddings_with_retry(pool, jobs)
+
+@bp.before_app_request
+def start_embedding_worker():
+    """
+    Starts the embedding worker thread on the first request, since it needs the connection pool from the WSGI environment.
+
+    Starting it with any request (rather than the first new event) means the recovery sweep runs soon after every restart.
     """
-    Adds an event with the given information to the database.
+    global _embedding_worker
+    if _embedding_worker is None:
+        with _embedding_worker_lock:
+            if _embedding_worker is None:
+                _embedding_worker = Thread(target=embedding_worker, args=(get_pool(read_connstr(request.environ["PSQL_CONF"])),), name="embedding", daemon=True)
+                _embedding_worker.start()
+
+def enqueue_embedding(eventid: int, text: str, texthash: bytes) -> None:
+    """
+    Schedules the embedding of the given event's text (see `embedding_text()`) to be computed and stored in the background.
+    If the job fails or is lost, the worker's recovery sweep queues it again (see `requeue_missing_embeddings()`).
+    """
+    _embedding_queue.put((eventid, text, texthash))
+
+def create_event(event: dict) -> int:
     """
+    Adds an event with the given information (see docstring for `create()`, with `start` and `end` already parsed) to the database.
+    The event's embedding is filled in shortly afterwards, in the background.
+    """
+    displayname, start, end, location, description = event["displayname"], event["start"], event["end"], event["location"], event.get("description")
+    text = embedding_text(displayname, description, location)
+    texthash = embedding_hash(text)
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
-    emb_str = displayname.strip().replace("\n", " ")
-    if description is not None:
-        emb_str += " " + description.strip().replace("\n", " ")
-    placename, _, _ = get_place_info(location)
-    if placename is not None:
-        emb_str += " " + placename.strip().replace("\n", " ")
-    embedding = emb.get_embedding(emb_str, engine="text-embedding-ada-002", user=str(g.userid))
     with g.conn.cursor() as cur:
-        cur.execute("INSERT INTO events(displayname, start, \"end\", place, host, embedding) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;", 
-                    (displayname, to_datetime(start), to_datetime(end, end=True), location, g.userid, embedding))
+        cur.execute("INSERT INTO events(displayname, start, \"end\", place, host, description, embedding_hash) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;", 
+                    (displayname, start, end, location, g.userid, description, texthash))
         id, = cur.fetchone()
-        if description is not None:
-            cur.execute("UPDATE events SET description = %s WHERE id = %s;", (description, id))
-        return id
+    enqueue_embedding(id, text, texthash)
+    return id
+
+def create_events_bulk(events: list[dict], batch_size: int = 1000) -> None:
+    """
+    Adds many events to the database at once, hosted by the logged-in user.
+    Each event is a dict in the same format as the argument of `create_event()`, and must already be validated.
+
+    Requires `g.userid` to be set (i.e., a function that calls it should be wrapped with `@authenticate`).
+
+    Embeddings are requested from OpenAI and rows are written with COPY, both in batches of `batch_size`.
+    """
+    assert isinstance(g.conn, psycopg.Connection)
+    assert isinstance(g.userid, int)
+    with g.conn.cursor() as cur:
+        for i in range(0, len(events), batch_size):
+            batch = events[i:i + batch_size]
+            texts = [embedding_text(e["displayname"], e.get("description"), e["location"]) for e in batch]
+            embeddings = emb.get_embeddings(texts, engine="text-embedding-ada-002")
+            with cur.copy("COPY events(displayname, start, \"end\", place, host, embedding, description, embedding_hash) FROM STDIN;") as copy:
+                for e, text, embedding in zip(batch, texts, embeddings):
+                    copy.write_row((e["displayname"], e["start"], e["end"], e["location"],
+                                    g.userid, pack_embedding(embedding), e.get("description"), embedding_hash(text)))
 
 @bp.route("", methods=["POST"])
 @authenticate
-def create() -> Response:
+@require_json_fields(displayname=str, description=(str, type(None)), location=str, start=dict, end=dict)
+def create(body: dict) -> Response:
     """
     API endpoint for creating a new event.
 
@@ -112,72 +339,34 @@ def create() -> Response:
     If a 200 status code is returned, the response body will contain a JSON object containing the following properties:
         - `id`: the ID of the event
     """
-    if request.json is None:
-        abort(415)
-    if not isinstance(request.json, dict):
-        abort(400)
-    if "displayname" not in request.json or not isinstance(request.json["displayname"], str):
-        abort(400)
-    if "description" in request.json and request.json["description"] is not None \
-        and not isinstance(request.json["description"], str):
-        abort(400)
-    if "location" not in request.json or not isinstance(request.json["location"], str):
-        abort(400)
-    if "start" not in request.json or not isinstance(request.json["start"], dict):
-        abort(400)
-    if "year" not in request.json["start"] or "month" not in request.json["start"] or "day" not in request.json["start"] \
-        or ("minute" in request.json["start"] and "hour" not in request.json["start"]):
-        abort(400)
-    if "end" not in request.json or not isinstance(request.json["end"], dict):
-        abort(400)
-    if "year" not in request.json["end"] or "month" not in request.json["end"] or "day" not in request.json["end"] \
-        or ("minute" in request.json["end"] and "hour" not in request.json["end"]):
-        abort(400)
-    try:
-        _ = int(request.json["start"]["year"])
-        _ = int(request.json["start"]["month"])
-        _ = int(request.json["start"]["day"])
-        _ = int(request.json["start"].get("hour", 0))
-        _ = int(request.json["start"].get("minute", 0))
-        _ = int(request.json["end"]["year"])
-        _ = int(request.json["end"]["month"])
-        _ = int(request.json["end"]["day"])
-        _ = int(request.json["end"].get("hour", 0))
-        _ = int(request.json["end"].get("minute", 0))
-    except ValueError:
-        abort(400)
-    errors = validate_create_inputs(**request.json)
+    event = dict(body, start=parse_date_json(body["start"]), end=parse_date_json(body["end"], end=True))
+    errors = validate_create_inputs(event)
     if errors:
         return (errors, 422)
-    return {"id": create_event(**request.json)}
+    return {"id": create_event(event)}
 
 
-def list_events():
+def list_events() -> str:
     """
     Return a list of events that the logged-in user is attending and/or hosting.
 
     Requires `g.userid` to be set (i.e., a function that calls this must be wrapped in `@authenticate`).
 
-    Returns a JSON object as described in the docstring for `event_list()`.
+    Returns a serialized JSON object as described in the docstring for `event_list()`.
+    The whole object is built by Postgres, so it can be sent as-is without being parsed in Python.
     """
-    attending = []
-    hosting = []
+    event_json = ("json_build_object('id', events.id, 'displayname', events.displayname, 'start', " + date_json_sql("events.start") + ", 'end', " + date_json_sql("events.\"end\"") + ", "
+                  "'description', events.description, 'venue', places.name, 'address', places.address, 'coords', json_build_object('lat', places.coords[0], 'lon', places.coords[1]))")
 
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.description, places.name, places.address, places.coords FROM ((attendees JOIN events ON attendees.eventid = events.id) JOIN places ON events.place = places.id) WHERE attendees.userid = %s;",
-                    (g.userid,))
-        for row in cur:
-            id, dname, start, end, description, pname, addr, coords = row
-            assert isinstance(coords, Point)
-            attending.append({"id": id, "displayname": dname, "start": from_datetime(start), "end": from_datetime(end), "description": description, "venue": pname, "address": addr, "coords": {"lat": coords.lat, "lon": coords.lon}})
-        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.description, places.name, places.address, places.coords FROM (events JOIN places ON events.place = places.id) WHERE host = %s;", (g.userid,))
-        for row in cur:
-            id, dname, start, end, description, pname, addr, coords = row
-            assert isinstance(coords, Point)
-            hosting.append({"id": id, "displayname": dname, "start": from_datetime(start), "end": from_datetime(end), "description": description, "venue": pname, "address": addr, "coords": {"lat": coords.lat, "lon": coords.lon}})
-    return {"attending": attending, "hosting": hosting}
+        cur.execute("SELECT json_build_object("
+                    "'attending', COALESCE((SELECT json_agg(" + event_json + ") FROM ((attendees JOIN events ON attendees.eventid = events.id) JOIN places ON events.place = places.id) WHERE attendees.userid = %s), '[]'::json), "
+                    "'hosting', COALESCE((SELECT json_agg(" + event_json + ") FROM (events JOIN places ON events.place = places.id) WHERE host = %s), '[]'::json))::text;",
+                    (g.userid, g.userid))
+        payload, = cur.fetchone()
+        return payload
 
 @bp.route("", methods=["GET"])
 @authenticate
@@ -192,6 +381,7 @@ def event_list():
     Status Codes:
         - 401: Need to authenticate.
         - 200: Request successful.
+        - 304: The list matches the ETag in `If-None-Match`.
     
     Output: a JSON object with the following properties:
         - `attending`: a list of events that the user is attending, with each event in the following form:
@@ -208,38 +398,39 @@ def event_list():
                 - `lon`: longitude
         - `hosting`: a list of events that the user is hosting, with events in the same form as those in `attending`.
     """
-    return list_events()
+    return conditional_response(Response(list_events(), mimetype="application/json"))
+
 
+def date_json_sql(column: str) -> str:
+    """
+    Returns a SQL expression that builds the JSON form of a datetime column (see `from_datetime()`) in Postgres.
+    """
+    return "json_build_object(%s)" % ", ".join("'%s', date_part('%s', %s)::int" % (field, field, column) for field in _DATE_FIELDS)
 
-def get_event_info(id: int) -> dict:
+def get_event_info(id: int) -> str | None:
     """
     Gets the info of the event with the given ID.
 
     Requires g.userid to be set (i.e., a function that calls it should be wrapped with @authenticate).
     
-    Returns a JSON object with the event data (see docstring for `event_get()`), or None if it does not exist.
+    Returns the event data as serialized JSON (see docstring for `event_get()`), or None if it does not exist.
+    The whole object is built by Postgres, so it can be sent as-is without being parsed in Python.
     """
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
-    info = None
     with g.conn.cursor() as cur:
-        cur.execute("SELECT events.displayname, events.start, events.\"end\", events.description, events.host, places.name, places.address, places.coords FROM (events JOIN places ON events.place = places.id) WHERE events.id = %s;", (id,))
-        if cur.rowcount == 0:
+        cur.execute("SELECT json_build_object("
+                    "'displayname', events.displayname, 'start', " + date_json_sql("events.start") + ", 'end', " + date_json_sql("events.\"end\"") + ", 'description', events.description, "
+                    "'host', json_build_object('id', events.host, 'username', hosts.username, 'displayname', hosts.displayname), "
+                    "'venue', places.name, 'address', places.address, 'coords', json_build_object('lat', places.coords[0], 'lon', places.coords[1]), "
+                    "'attendees', COALESCE((SELECT json_agg(json_build_object('id', users.id, 'username', users.username, 'displayname', users.displayname)) "
+                    "FROM attendees JOIN users ON users.id = attendees.userid WHERE attendees.eventid = events.id), '[]'::json), "
+                    "'attending', EXISTS(SELECT 1 FROM attendees WHERE eventid = events.id AND userid = %s))::text "
+                    "FROM events JOIN places ON events.place = places.id LEFT JOIN users AS hosts ON hosts.id = events.host WHERE events.id = %s;", (g.userid, id))
+        row = cur.fetchone()
+        if row is None:
             return None
-        name, start, end, description, host, pname, addr, coords = cur.fetchone()
-        assert isinstance(coords, Point)
-        info = {"displayname": name, "start": from_datetime(start), "end": from_datetime(end), "description": description, "host": {"id": host}, "venue": pname, "address": addr, "coords": {"lat": coords.lat, "lon": coords.lon}, "attendees": [], "attending": False}
-        cur.execute("SELECT username, displayname FROM users WHERE id = %s;", (host,))
-        uname, udname = cur.fetchone()
-        info["host"]["username"] = uname
-        info["host"]["displayname"] = udname
-        cur.execute("SELECT attendees.userid, users.username, users.displayname FROM (attendees JOIN users ON users.id = attendees.userid) WHERE eventid = %s;", (id,))
-        for row in cur:
-            uid, uname, udname = row
-            info["attendees"].append({"id": uid, "username": uname, "displayname": udname})
-            if uid == g.userid:
-                info["attending"] = True
-    return info
+        return row[0]
 
 @bp.route("/<int:eventid>", methods=["GET"])
 @authenticate
@@ -253,6 +444,7 @@ def event_get(eventid: int) -> Response:
         - 401: Need to authenticate.
         - 404: Event does not exist.
         - 200: Request successful.
+        - 304: The event matches the ETag in `If-None-Match`.
 
     On 200, returns a JSON object with the following properties:
         - `displayname`: the display name of the event
@@ -274,7 +466,7 @@ def event_get(eventid: int) -> Response:
     info = get_event_info(eventid)
     if info is None:
         abort(404)
-    return info
+    return conditional_response(Response(info, mimetype="application/json"))
 
 
 def event_add_user(eventid: int, userid: int) -> Response:
@@ -288,20 +480,21 @@ def event_add_user(eventid: int, userid: int) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
 
+    # Users can only add themselves, which needs no database access to check.
+    if userid != g.userid:
+        abort(403)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM events WHERE id = %s;", (eventid,))
-        count, = cur.fetchone()
-        if count == 0:
-            abort(404)
-        if userid != g.userid:
-            abort(403)
-        cur.execute("SELECT COUNT(*) FROM attendees WHERE userid = %s AND eventid = %s;", (g.userid, eventid))
-        count, = cur.fetchone()
-        if count == 0:
-            cur.execute("INSERT INTO attendees(userid, eventid) VALUES (%s, %s);", (g.userid, eventid))
+        # The second column tells a missing event (404) apart from a user who was already attending (204).
+        cur.execute("WITH inserted AS (INSERT INTO attendees(userid, eventid) SELECT %s, %s WHERE EXISTS(SELECT 1 FROM events WHERE id = %s) "
+                    "ON CONFLICT (userid, eventid) DO NOTHING RETURNING 1) "
+                    "SELECT EXISTS(SELECT 1 FROM inserted), EXISTS(SELECT 1 FROM events WHERE id = %s);",
+                    (g.userid, eventid, eventid, eventid))
+        inserted, exists = cur.fetchone()
+        if inserted:
             return ("", 201)
-        else:
-            return ("", 204)
+        if not exists:
+            abort(404)
+        return ("", 204)
 
 @bp.route("/<int:eventid>/user/<int:userid>", methods=["PUT"])
 @authenticate
@@ -337,15 +530,18 @@ def event_remove_user(eventid: int, userid: int) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        if g.userid != userid:
-            cur.execute("SELECT host FROM events WHERE id = %s;", (eventid,))
+        if g.userid == userid:
+            cur.execute("DELETE FROM attendees WHERE userid = %s AND eventid = %s;", (userid, eventid))
             if cur.rowcount == 0:
                 abort(404)
-            host, = cur.fetchone()
-            if g.userid != host:
-                abort(403)
-        cur.execute("DELETE FROM attendees WHERE userid = %s AND eventid = %s;", (userid, eventid))
+            return ("", 204)
+        cur.execute("DELETE FROM attendees WHERE userid = %s AND eventid = %s AND EXISTS(SELECT 1 FROM events WHERE id = %s AND host = %s);",
+                    (userid, eventid, eventid, g.userid))
         if cur.rowcount == 0:
+            cur.execute("SELECT host FROM events WHERE id = %s;", (eventid,))
+            row = cur.fetchone()
+            if row is not None and row[0] != g.userid:
+                abort(403)
             abort(404)
     return ("", 204)
         
@@ -383,13 +579,11 @@ def delete_event(eventid: int) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT host FROM events WHERE id = %s;", (eventid,))
+        cur.execute("DELETE FROM events WHERE id = %s AND host = %s;", (eventid, g.userid))
         if cur.rowcount == 0:
-            abort(404)
-        host, = cur.fetchone()
-        if host != g.userid:
-            abort(403)
-        cur.execute("DELETE FROM events WHERE id = %s;", (eventid,))
+            cur.execute("SELECT EXISTS(SELECT 1 FROM events WHERE id = %s);", (eventid,))
+            exists, = cur.fetchone()
+            abort(403 if exists else 404)
         return ("", 204)
 
 @bp.route("/<int:eventid>", methods=["DELETE"])
@@ -414,10 +608,10 @@ def event_delete(eventid: int):
     return delete_event(eventid)
 
 
-def update_event_settings(eventid: int, **kwargs) -> Response:
+def update_event_settings(eventid: int, settings: dict) -> Response:
     """
-    Updates the settings for the given event to those in **kwargs.
-    If a setting is listed in **kwargs, it will be updated. Otherwise, it will remain the same.
+    Updates the settings for the given event to those in `settings` (with `start` and `end` already parsed).
+    If a setting is listed in `settings`, it will be updated. Otherwise, it will remain the same.
 
     Requires `g.userid` to be set.
 
@@ -426,37 +620,42 @@ def update_event_settings(eventid: int, **kwargs) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT host, displayname, start, end, location, description, embedding FROM events WHERE id = %s;", (eventid,))
-        if cur.rowcount == 0:
+        cur.execute("SELECT host, displayname, start, \"end\", place, description, embedding_hash FROM events WHERE id = %s;", (eventid,))
+        row = cur.fetchone()
+        if row is None:
             abort(404)
-        host, displayname, start, end, location, description, embedding = cur.fetchone()
+        host, displayname, start, end, location, description, oldhash = row
         if g.userid != host:
             abort(403)
-        if "displayname" in kwargs:
-            displayname = kwargs["displayname"]
-        if "start" in kwargs:
-            start = to_datetime(kwargs["start"])
-        if "end" in kwargs:
-            end = to_datetime(kwargs["end"], end=True)
-        if "description" in kwargs:
-            description = kwargs["description"]
-        if "location" in kwargs:
-            location = kwargs["location"]
-        errors = validate_create_inputs(displayname, start, end, description, location)
+        current = {"displayname": displayname, "start": start, "end": end, "description": description, "location": location}
+        changed = {key: settings[key] for key in current if key in settings and settings[key] != current[key]}
+        event = {**current, **changed}
+        errors = validate_create_inputs(event)
         if errors:
             return (errors, 422)
-        if "displayname" in kwargs or "description" in kwargs:
-            assert isinstance(displayname, str)
-            assert isinstance(description, str)
-            placename, _, _ = get_place_info(location)
-            embedding = emb.get_embedding(displayname.strip().replace("\n", " ") + " " + description.strip().replace("\n", " ") + (placename.strip().replace("\n", " ") if placename is not None else ""), engine="text-embedding-ada-002", user=str(g.userid))
-        cur.execute("UPDATE events SET displayname = %s, start=%s, \"end\"=%s, description = %s, place = %s, embedding = %s WHERE id = %s;",
-                    (displayname, start, end, description if description is not None else "", location, embedding, eventid))
-        return ("", 204)
+        text = texthash = None
+        if changed.keys() & {"displayname", "description", "location"}:
+            text = embedding_text(event["displayname"], event["description"], event["location"])
+            texthash = embedding_hash(text)
+        # Only write the columns that actually change, so untouched columns and their indexes are left alone.
+        assignments = [sql.SQL("{} = %s").format(sql.Identifier(_SETTING_COLUMNS[key])) for key in changed]
+        params = list(changed.values())
+        if texthash is not None and texthash != oldhash:
+            # The old embedding no longer matches, so clear it until the new one is computed.
+            assignments.append(sql.SQL("embedding = NULL, embedding_hash = %s, embedding_requested = now()"))
+            params.append(texthash)
+        else:
+            text = None
+        if assignments:
+            cur.execute(sql.SQL("UPDATE events SET {} WHERE id = %s;").format(sql.SQL(", ").join(assignments)), (*params, eventid))
+    if text is not None:
+        enqueue_embedding(eventid, text, texthash)
+    return ("", 204)
 
 @bp.route("/<int:eventid>", methods=["PATCH"])
 @authenticate
-def event_patch(eventid: int):
+@require_json_fields(displayname=(str, type(None)), description=(str, type(None)), location=(str, type(None)), start=(dict, type(None)), end=(dict, type(None)))
+def event_patch(body: dict, eventid: int):
     """
     Update the settings for the given event.
     Only the event's host can change its settings.
@@ -474,6 +673,7 @@ def event_patch(eventid: int):
     Status Codes:
         - 401: Need to authenticate.
         - 415: Request body is not in JSON format.
+        - 400: JSON syntax is invalid, or a setting has the wrong type.
         - 404: Event does not exist.
         - 403: User is not authorized to make changes.
         - 422: One or more of the setting changes are invalid.
@@ -485,50 +685,18 @@ def event_patch(eventid: int):
         - `field`: the field in which the error occurred
         - `description`: a description of the error
     """
-    if request.json is None:
-        abort(415)
-    if not isinstance(request.json, dict):
-        abort(400)
-    if "displayname" in request.json and not isinstance(request.json["displayname"], str):
-        abort(400)
-    if "start" in request.json:
-        if not isinstance(request.json["start"], dict):
-            abort(400)
-        if "year" not in request.json["start"] or "month" not in request.json["start"] or "day" not in request.json["start"] \
-            or ("minute" in request.json["start"] and "hour" not in request.json["start"]):
-            abort(400)
-    if "end" in request.json:
-        if not isinstance(request.json["end"], dict):
+    for field in ("displayname", "location", "start", "end"):
+        if field in body and body[field] is None:
             abort(400)
-        if "year" not in request.json["end"] or "month" not in request.json["end"] or "day" not in request.json["end"] \
-            or ("minute" in request.json["end"] and "hour" not in request.json["end"]):
-            abort(400)
-    try:
-        if "start" in request.json:
-            _ = int(request.json["start"]["year"])
-            _ = int(request.json["start"]["month"])
-            _ = int(request.json["start"]["day"])
-            _ = int(request.json["start"].get("hour", 0))
-            _ = int(request.json["start"].get("minute", 0))
-        if "end" in request.json:
-            _ = int(request.json["end"]["year"])
-            _ = int(request.json["end"]["month"])
-            _ = int(request.json["end"]["day"])
-            _ = int(request.json["end"].get("hour", 0))
-            _ = int(request.json["end"].get("minute", 0))
-    except ValueError:
-        abort(400)
-    if "description" in request.json and request.json["description"] is not None \
-        and not isinstance(request.json["description"], str):
-        abort(400)
-    if "location" not in request.json or not isinstance(request.json["location"], str):
-        abort(400)
-    if "eventid" in request.json:
-        abort(400)
-    return update_event_settings(eventid = eventid, **request.json)
+    settings = dict(body)
+    if "start" in body:
+        settings["start"] = parse_date_json(body["start"])
+    if "end" in body:
+        settings["end"] = parse_date_json(body["end"], end=True)
+    return update_event_settings(eventid, settings)
 
 
-def validate_message(text: str, **kwargs) -> Response | None:
+def validate_message(text: str) -> Response | None:
     """
     Ensures the given message is valid.
 
@@ -540,7 +708,7 @@ def validate_message(text: str, **kwargs) -> Response | None:
         return {"description": "Message must not be more than 2000 characters."}
     return None
 
-def send_message(eventid: int, text: str, **kwargs) -> Response:
+def send_message(eventid: int, text: str) -> Response:
     """
     Sends a message with the given content to the event with the given id.
 
@@ -551,27 +719,27 @@ def send_message(eventid: int, text: str, **kwargs) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM events WHERE id = %s;", (eventid,))
-        count, = cur.fetchone()
-        if count == 0:
-            abort(404)
-        cur.execute("SELECT COUNT(*) FROM attendees WHERE userid = %s AND eventid = %s;", (g.userid, eventid))
-        count, = cur.fetchone()
-        if count == 0:
-            abort(403)
-        for _ in range(100):
-            try:
-                cur.execute("INSERT INTO messages(eventid, sender, content) VALUES (%s, %s, %s) RETURNING time;", (eventid, g.userid, text))
-                time, = cur.fetchone()
-                return {"time": time}
-            except psycopg.errors.UniqueViolation:
-                sleep(0.01)
-        print("Error: server timeout while posting message to event %d." % eventid)
-        abort(500)
+        # Serialize posting per event so the next timestamp can be picked without racing on messages(eventid, time).
+        # The pipeline sends BEGIN, the lock, the INSERT, and COMMIT in a single round-trip.
+        with g.conn.pipeline(), g.conn.transaction():
+            g.conn.execute("SELECT pg_advisory_xact_lock(%s);", (eventid,))
+            # Only attendees can post, so the attendance row doubles as the existence check.
+            cur.execute("INSERT INTO messages(eventid, sender, content, time) "
+                        "SELECT %s, %s, %s, GREATEST(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint, (SELECT COALESCE(MAX(time), 0) + 1 FROM messages WHERE eventid = %s)) "
+                        "WHERE EXISTS(SELECT 1 FROM attendees WHERE userid = %s AND eventid = %s) RETURNING time;",
+                        (eventid, g.userid, text, eventid, g.userid, eventid))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("SELECT EXISTS(SELECT 1 FROM events WHERE id = %s);", (eventid,))
+            exists, = cur.fetchone()
+            abort(403 if exists else 404)
+        time, = row
+        return {"time": time}
 
 @bp.route("/<int:eventid>/chat", methods=["POST"])
 @authenticate
-def chat_post(eventid: int) -> Response:
+@require_json_fields(text=str)
+def chat_post(body: dict, eventid: int) -> Response:
     """
     Post a new message to the event's chat.
     Requires the logged-in user to be attending the event.
@@ -588,7 +756,6 @@ def chat_post(eventid: int) -> Response:
         - 422: Message was invalid.
         - 404: Event does not exist.
         - 403: User is not authorized to make this request.
-        - 500: Server timed out while sending message.
         - 200: Request succeeded.
     
     On a 200 (successful) status code, a JSON object with the following values will be returned.
@@ -597,16 +764,10 @@ def chat_post(eventid: int) -> Response:
     An invalid (422) response will contain a JSON object with the following properties:
         - `description`: a description of the error
     """
-    if not isinstance(request.json, dict):
-        abort(400)
-    if "text" not in request.json or not isinstance(request.json["text"], str):
-        abort(400)
-    if "eventid" in request.json:
-        abort(400)
-    errors = validate_message(eventid = eventid, **request.json)
+    errors = validate_message(body["text"])
     if errors is not None:
-        return errors
-    return send_message(eventid = eventid, **request.json)
+        return (errors, 422)
+    return send_message(eventid, body["text"])
 
 
 def most_recent_messages(since: int | None, eventid: int, n = 20) -> Response:
@@ -617,40 +778,27 @@ def most_recent_messages(since: int | None, eventid: int, n = 20) -> Response:
 
     Returns a list of at most `n` messages (see the docstring for `chat_get()`) if no error is thrown.
     """
-    messages = []
-
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT host FROM events WHERE id = %s;", (eventid,))
-        if cur.rowcount == 0:
+        cur.execute("SELECT host = %s OR EXISTS(SELECT 1 FROM attendees WHERE userid = %s AND eventid = events.id) FROM events WHERE id = %s;",
+                    (g.userid, g.userid, eventid))
+        row = cur.fetchone()
+        if row is None:
             abort(404)
-        host, = cur.fetchone()
-        if g.userid != host:
-            cur.execute("SELECT COUNT(*) FROM attendees WHERE userid = %s AND eventid = %s;", (g.userid, eventid))
-            count, = cur.fetchone()
-            if count == 0:
-                abort(403)
-        if since is None:
-            cur.execute("SELECT messages.time, messages.content, users.id, users.username, users.displayname \
-                    FROM (messages LEFT JOIN users ON messages.sender = users.id) \
-                    WHERE messages.eventid = %s \
-                    ORDER BY messages.time DESC LIMIT %s;", (eventid, n))
-        else:
-            cur.execute("SELECT messages.time, messages.content, users.id, users.username, users.displayname \
-                    FROM (messages LEFT JOIN users ON messages.sender = users.id) \
-                    WHERE messages.eventid = %s AND messages.time < %s\
-                    ORDER BY messages.time DESC LIMIT %s;", (eventid, since, n))
-        for row in cur:
-            time, text, uid, uname, dname = row
-            msg = {"time": time, "text": text, "sender": None}
-            if uid is not None:
-                msg["sender"] = {"id": uid, "username": uname, "displayname": dname}
-            messages.append(msg)
+        if not row[0]:
+            abort(403)
+        # Always bound the time so both the first page and later pages share one prepared statement.
+        cur.execute("SELECT messages.time, messages.content, users.id, users.username, users.displayname "
+                    "FROM (messages LEFT JOIN users ON messages.sender = users.id) "
+                    "WHERE messages.eventid = %s AND messages.time < %s "
+                    "ORDER BY messages.time DESC LIMIT %s;", (eventid, since if since is not None else _MAX_BIGINT, n))
+        messages = [{"time": time, "text": text, "sender": {"id": uid, "username": uname, "displayname": dname} if uid is not None else None}
+                    for time, text, uid, uname, dname in cur]
     return messages
 
 @bp.route("/<int:eventid>/chat", methods=["GET"], defaults={"time": None})
-@bp.route("/<int:eventid>/chat/<int:time>")
+@bp.route("/<int:eventid>/chat/<int:time>", methods=["GET"])
 @authenticate
 def chat_get(eventid: int, time: int | None) -> Response:
     """
@@ -691,17 +839,12 @@ def delete_message(eventid: int, time: int) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT host FROM events WHERE id = %s;", (eventid,))
+        cur.execute("DELETE FROM messages WHERE eventid = %s AND time = %s AND (sender = %s OR EXISTS(SELECT 1 FROM events WHERE id = %s AND host = %s));",
+                    (eventid, time, g.userid, eventid, g.userid))
         if cur.rowcount == 0:
-            abort(404)
-        host, = cur.fetchone()
-        cur.execute("SELECT sender FROM messages WHERE eventid = %s AND time = %s;", (eventid, time))
-        if cur.rowcount == 0:
-            abort(404)
-        sender, = cur.fetchone()
-        if g.userid != host and (sender is None or g.userid != sender):
-            abort(403)
-        cur.execute("DELETE FROM messages WHERE eventid = %s AND time = %s;", (eventid, time))
+            cur.execute("SELECT EXISTS(SELECT 1 FROM messages WHERE eventid = %s AND time = %s);", (eventid, time))
+            exists, = cur.fetchone()
+            abort(403 if exists else 404)
         return ("", 204)
 
 @bp.route("/<int:eventid>/chat/<int:time>", methods=["DELETE"])
@@ -726,28 +869,41 @@ def chat_delete(eventid: int, time: int):
     return delete_message(eventid, time)
 
 
+def search_conditions(location: Point | None, distance: float, earliest: datetime | None, latest: datetime | None) -> tuple[list[str], list]:
+    """
+    Builds the SQL conditions shared by the event searches, and their parameters.
+    """
+    # Filtering happens in Postgres (earthdistance), so the GiST index on places can be used.
+    conditions = ["TRUE"]
+    params = []
+    if location is not None and distance != float("inf"):
+        conditions.append("earth_box(ll_to_earth(%s, %s), %s) @> ll_to_earth(places.coords[0], places.coords[1])")
+        conditions.append("earth_distance(ll_to_earth(%s, %s), ll_to_earth(places.coords[0], places.coords[1])) <= %s")
+        params += [location.lat, location.lon, distance * _METERS_PER_MILE] * 2
+    if earliest is not None:
+        conditions.append("events.\"end\" >= %s")
+        params.append(earliest)
+    if latest is not None:
+        conditions.append("events.start <= %s")
+        params.append(latest)
+    return conditions, params
+
 def get_events_by_location(location: Point, distance: float, earliest: datetime | None = None, latest: datetime | None = None) -> list:
     """
     List all events not more than `distance` miles from `location`, sorted by distance in ascending order.
 
     If `earliest` or `latest` are given, the results are constrained to these boundaries.
     """
+    conditions, params = search_conditions(location, distance, earliest, latest)
     assert isinstance(g.conn, psycopg.Connection)
-    with g.conn.cursor() as cur:
-        events = []
-        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.description, places.name, places.address, places.coords FROM (events JOIN places ON events.place = places.id);")
-        for row in cur:
-            id, dname, start, end, description, pname, addr, coords = row
-            if earliest is not None and end < earliest:
-                continue
-            if latest is not None and start > latest:
-                continue
-            assert isinstance(coords, Point)
-            dist = location.distanceto(coords)
-            if dist.miles <= distance:
-                events.append({"id": id, "displayname": dname, "distance": dist.miles, "coords": {"lat": coords.lat, "lon": coords.lon}, "start": from_datetime(start), "end": from_datetime(end), "venue": pname, "address": addr, "description": description})
-        events.sort(key=lambda x: x["distance"])
-        return events
+    # Binary results let `PointBinaryLoader` unpack the coordinates directly.
+    with g.conn.cursor(binary=True) as cur:
+        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.description, places.name, places.address, places.coords, "
+                    "earth_distance(ll_to_earth(%s, %s), ll_to_earth(places.coords[0], places.coords[1])) / %s AS miles "
+                    "FROM (events JOIN places ON events.place = places.id) WHERE " + " AND ".join(conditions) + " ORDER BY miles;",
+                    [location.lat, location.lon, _METERS_PER_MILE] + params)
+        return [{"id": id, "displayname": dname, "distance": miles, "coords": {"lat": coords.lat, "lon": coords.lon}, "start": from_datetime(start), "end": from_datetime(end), "venue": pname, "address": addr, "description": description}
+                for id, dname, start, end, description, pname, addr, coords, miles in cur]
 
 def get_events_by_keyword(query: str, earliest: datetime | None = None, latest: datetime | None = None, location: Point | None = None, distance: float = float("inf")):
     """
@@ -757,28 +913,21 @@ def get_events_by_keyword(query: str, earliest: datetime | None = None, latest:
     """
     assert isinstance(g.conn, psycopg.Connection)
     assert isinstance(g.userid, int)
-    if not query.strip():
+    query = _WHITESPACE_RE.sub(" ", query).strip()
+    if not query:
         abort(400)
-    with g.conn.cursor() as cur:
-        events = []
-        cur.execute("SELECT events.id, events.displayname, events.embedding, events.start, events.\"end\", events.description, places.name, places.address, places.coords FROM (events JOIN places ON events.place = places.id);")
-        for row in cur:
-            id, dname, evemb, start, end, description, pname, addr, coords = row
-            if earliest is not None and end < earliest:
-                continue
-            if latest is not None and start > latest:
-                continue
-            if location is not None and location.distanceto(coords).miles > distance:
-                continue
-            events.append({"id": id, "displayname": dname, "description": description, "venue": pname, "address": addr, "coords": coords, "embedding": evemb, "distance": None, "start": from_datetime(start), "end": from_datetime(end)})
-            if location is not None:
-                events[-1]["distance"] = location.distanceto(coords).miles
-        if len(events) >= 2:
-            embedding = emb.get_embedding(query.strip().replace("\n", " "), engine="text-embedding-ada-002", user=str(g.userid))
-            events.sort(key=lambda x: -emb.cosine_similarity(embedding, x["embedding"]))
-        for i in range(len(events)):
-            events[i].pop("embedding")
-        return events
+    conditions, params = search_conditions(location, distance, earliest, latest)
+    distancesql, distanceparams = "NULL", []
+    if location is not None:
+        distancesql, distanceparams = "earth_distance(ll_to_earth(%s, %s), ll_to_earth(places.coords[0], places.coords[1])) / %s", [location.lat, location.lon, _METERS_PER_MILE]
+    with g.conn.cursor(binary=True) as cur:
+        # Ranking happens in Postgres (pgvector), so embeddings never leave the database.
+        # Events whose embedding is still being computed have a NULL distance, which sorts last.
+        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.description, places.name, places.address, places.coords, " + distancesql + " AS miles "
+                    "FROM (events JOIN places ON events.place = places.id) WHERE " + " AND ".join(conditions) + " ORDER BY events.embedding <=> %s::vector;",
+                    distanceparams + params + [get_query_embedding(query)])
+        return [{"id": id, "displayname": dname, "description": description, "venue": pname, "address": addr, "coords": coords, "distance": miles, "start": from_datetime(start), "end": from_datetime(end)}
+                for id, dname, start, end, description, pname, addr, coords, miles in cur]
 
 @bp.route("/search", methods=["GET"])
 @authenticate
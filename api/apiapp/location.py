@@ -2,12 +2,21 @@ from flask import Blueprint, g, request, Response, abort
 from dataclasses import dataclass
 from geopy.distance import geodesic as gd
 import psycopg
+from psycopg.types.json import Jsonb
+import numpy as np
+from datetime import timedelta
+from functools import lru_cache
 import googlemaps
 import googlemaps.geocoding
 import googlemaps.places
+from .auth import require_json_fields
 
 bp = Blueprint("location", __name__, url_prefix="/location")
 
+_EARTH_RADIUS_MILES = 3958.756
+_GEOCODE_CACHE_SCALE = 10 ** 5
+_GEOCODE_CACHE_TTL = timedelta(days=1)
+
 @dataclass
 class Place:
     id: str
@@ -15,7 +24,7 @@ class Place:
     addr : str
     types: list[str]
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Point:
     lat: float
     lon: float
@@ -24,40 +33,82 @@ class Point:
         assert isinstance(dest, Point)
         return gd((self.lat, self.lon), (dest.lat, dest.lon))
     
+    def reverse_geocode(self) -> list:
+        """
+        Returns Google's reverse geocoding response for the points of interest at this point.
+
+        Responses are cached in `reverse_geocode_cache` for `_GEOCODE_CACHE_TTL`, on a grid of about a meter.
+        """
+        latbin, lonbin = round(self.lat * _GEOCODE_CACHE_SCALE), round(self.lon * _GEOCODE_CACHE_SCALE)
+        assert isinstance(g.conn, psycopg.Connection)
+        with g.conn.cursor() as cur:
+            cur.execute("SELECT response FROM reverse_geocode_cache WHERE latbin = %s AND lonbin = %s AND expires > now();", (latbin, lonbin))
+            row = cur.fetchone()
+            if row is not None:
+                return row[0]
+            response = googlemaps.geocoding.reverse_geocode(client=g.gmaps, latlng=(self.lat, self.lon), result_type="point_of_interest")
+            cur.execute("INSERT INTO reverse_geocode_cache(latbin, lonbin, response, expires) VALUES (%s, %s, %s, now() + %s) "
+                        "ON CONFLICT (latbin, lonbin) DO UPDATE SET response = EXCLUDED.response, expires = EXCLUDED.expires;",
+                        (latbin, lonbin, Jsonb(response), _GEOCODE_CACHE_TTL))
+            return response
+
     def getplaces(self) -> list[Place]:
-        response = googlemaps.geocoding.reverse_geocode(client=g.gmaps, latlng=(self.lat, self.lon), result_type="point_of_interest")
+        response = self.reverse_geocode()
         assert isinstance(g.conn, psycopg.Connection)
-        places = []
+        ids = [i["place_id"] for i in response]
         with g.conn.cursor() as cur:
-            for i in response:
-                id = i["place_id"]
-                addr = i["formatted_address"]
-                coords = i["geometry"]["location"]
-                lat = float(coords["lat"])
-                lon = float(coords["lng"])
-                loc = Point(lat, lon)
-                cur.execute("SELECT COUNT(*) FROM places WHERE id = %s;", (id,))
-                count, = cur.fetchone()
-                if count == 0:
-                    name = googlemaps.places.place(client=g.gmaps, place_id=id, fields=["name"])["result"]["name"]
-                    cur.execute("INSERT INTO places(id, name, address, coords) VALUES (%s, %s, %s, %s);", (id, name, addr, loc))
-                    for t in i["types"]:
-                        cur.execute("INSERT INTO placetypes(id, type) VALUES (%s, %s);", (id, t))
-                cur.execute("SELECT name FROM places WHERE id = %s;", (id,))
-                name, = cur.fetchone()
-                cur.execute("SELECT type FROM placetypes WHERE id = %s;", (id,))
-                types = [i[0] for i in cur.fetchall()]
-                places.append(Place(id, name, addr, types))
-        return places
+            cur.execute("SELECT id, name FROM places WHERE id = ANY(%s);", (ids,))
+            names = dict(cur.fetchall())
+            types = {}
+            # Deduplicated by ID, since a place may be listed more than once.
+            missing = list({i["place_id"]: i for i in response if i["place_id"] not in names}.values())
+            for i in missing:
+                names[i["place_id"]] = get_place_name(i["place_id"])
+            if missing:
+                cur.execute("INSERT INTO places(id, name, address, coords) SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::point[]) "
+                            "ON CONFLICT (id) DO NOTHING RETURNING id;",
+                            ([i["place_id"] for i in missing], [names[i["place_id"]] for i in missing], [i["formatted_address"] for i in missing],
+                             [Point(float(i["geometry"]["location"]["lat"]), float(i["geometry"]["location"]["lng"])) for i in missing]))
+                # Only places inserted just now need their types recorded; a concurrent request may have inserted the rest.
+                inserted = {id for id, in cur.fetchall()}
+                types = {i["place_id"]: i["types"] for i in missing if i["place_id"] in inserted}
+                newtypes = [(id, t) for id, placetypes in types.items() for t in placetypes]
+                if newtypes:
+                    cur.execute("INSERT INTO placetypes(id, type) SELECT * FROM unnest(%s::text[], %s::text[]);",
+                                ([id for id, _ in newtypes], [t for _, t in newtypes]))
+            # Types of places inserted just now are already known from the response; only look up the rest.
+            known = [id for id in dict.fromkeys(ids) if id not in types]
+            if known:
+                types.update((id, []) for id in known)
+                cur.execute("SELECT id, type FROM placetypes WHERE id = ANY(%s);", (known,))
+                for id, t in cur:
+                    types[id].append(t)
+        return [Place(i["place_id"], names[i["place_id"]], i["formatted_address"], types[i["place_id"]]) for i in response]
+
+@lru_cache(maxsize=2048)
+def get_place_name(placeid: str) -> str:
+    """
+    Looks up the name of the place with the given ID with Google Places.
+    """
+    return googlemaps.places.place(client=g.gmaps, place_id=placeid, fields=["name"])["result"]["name"]
+
+def haversine_miles(origin: Point, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """
+    Returns the great-circle distances, in miles, from `origin` to each of the given coordinates (in degrees).
+    Within about 0.5% of `Point.distanceto()`, but computed for all coordinates at once.
+    """
+    lat0, lon0 = np.radians(origin.lat), np.radians(origin.lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2) ** 2
+    return 2 * _EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
 
 def get_place_info(placeid: str) -> tuple[str | None, str, Point] | None:
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM places WHERE id = %s;", (placeid, ))
-        count, = cur.fetchone()
-        if count != 0:
-            cur.execute("SELECT name, address, coords FROM places WHERE id = %s;", (placeid,))
-            name, addr, loc = cur.fetchone()
+        cur.execute("SELECT name, address, coords FROM places WHERE id = %s;", (placeid,))
+        row = cur.fetchone()
+        if row is not None:
+            name, addr, loc = row
             return name, addr, loc
         response = googlemaps.geocoding.geocode(client=g.gmaps, place_id=placeid)
         if response:
@@ -66,52 +117,48 @@ def get_place_info(placeid: str) -> tuple[str | None, str, Point] | None:
             lat = float(coords["lat"])
             lon = float(coords["lng"])
             loc = Point(lat, lon)
-            cur.execute("INSERT INTO places(id, address, coords) VALUES (%s, %s, %s);", (placeid, addr, loc))
             name = None
             if "point_of_interest" in response[0]["types"]:
-                name = googlemaps.places.place(client=g.gmaps, place_id=placeid, fields=["name"])["result"]["name"]
-                cur.execute("UPDATE places SET name = %s WHERE id = %s;", (name, placeid))
-                for t in response[0]["types"]:
-                    cur.execute("INSERT INTO placetypes(id, type) VALUES (%s, %s);", (placeid, t))
+                name = get_place_name(placeid)
+            cur.execute("INSERT INTO places(id, name, address, coords) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING RETURNING id;", (placeid, name, addr, loc))
+            # A concurrent lookup of the same place may have inserted it (and its types) first.
+            if cur.fetchone() is not None and name is not None:
+                cur.executemany("INSERT INTO placetypes(id, type) VALUES (%s, %s);", [(placeid, t) for t in response[0]["types"]])
             return (name, addr, loc)
         return None
 
 
 
+@lru_cache(maxsize=4)
+def get_gmaps_client(filename: str) -> googlemaps.Client:
+    """
+    Returns the Google Maps client for the API key in the given file.
+
+    The result is cached, so each process reads the key and sets up its HTTP session only once.
+    """
+    with open(filename) as file:
+        return googlemaps.Client(key=file.read())
+
 @bp.before_app_request
 def get_google_api_key():
-    with open(request.environ["GOOGLE_API_KEY_PATH"]) as file:
-        google_api_key = file.read()
-        g.gmaps = googlemaps.Client(key=google_api_key)
+    g.gmaps = get_gmaps_client(request.environ["GOOGLE_API_KEY_PATH"])
 
 def visit_location(location: Point, eventid: int) -> Response:
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM events WHERE id = %s;", (eventid,))
-        count, = cur.fetchone()
-        if count == 0:
+        cur.execute("SELECT EXISTS(SELECT 1 FROM events WHERE id = %s);", (eventid,))
+        exists, = cur.fetchone()
+        if not exists:
             abort(404)
         places = location.getplaces()
-        for i in places:
-            cur.execute("SELECT COUNT(*) FROM locations WHERE placeid = %s AND eventid = %s;", (i.id, eventid))
-            count, = cur.fetchone()
-            if count == 0:
-                cur.execute("INSERT INTO locations(placeid, eventid) VALUES (%s, %s);", (i.id, eventid))
-            cur.execute("UPDATE locations SET visits = visits + 1 WHERE placeid = %s AND eventid = %s;", (i.id, eventid))
+        cur.executemany("INSERT INTO locations(placeid, eventid, visits) VALUES (%s, %s, 1) "
+                        "ON CONFLICT (placeid, eventid) DO UPDATE SET visits = locations.visits + 1;", [(i.id, eventid) for i in places])
     return ("", 204)
 
 
 @bp.route("/event/<int:eventid>", methods=["POST"])
-def location_get(eventid: int):
-    if request.json is None:
-        abort(415)
-    if "lat" not in request.json or "lon" not in request.json:
-        abort(400)
-    try:
-        lat = float(request.json["lat"])
-        lon = float(request.json["lon"])
-        location = Point(lat, lon)
-        return visit_location(location, eventid)
-    except ValueError:
+@require_json_fields(lat=(int, float), lon=(int, float))
+def location_get(body: dict, eventid: int):
+    if not -90 <= body["lat"] <= 90 or not -180 <= body["lon"] <= 180:
         abort(400)
-    
\ No newline at end of file
+    return visit_location(Point(body["lat"], body["lon"]), eventid)
\ No newline at end of file
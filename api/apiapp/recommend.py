@@ -1,12 +1,41 @@
 from flask import Blueprint, g, request, abort
 from .auth import authenticate
-from .location import Point
+from .location import Point, haversine_miles
 import googlemaps.places
 import psycopg
+from psycopg.types.json import Jsonb
+from datetime import timedelta
+import numpy as np
 from dataclasses import dataclass
 
 bp = Blueprint("recommend", __name__, url_prefix="/recommend")
 
+_METERS_PER_MILE = 1609.344
+_MAX_RADIUS_METERS = 50000
+_PLACES_CACHE_SCALE = 10 ** 3
+_PLACES_CACHE_RADIUS_STEP = 100
+_PLACES_CACHE_TTL = timedelta(days=1)
+
+def search_places(category: str, loc: Point, radius: float) -> list[dict]:
+    """
+    Returns Google's text search results for `category` around `loc`, within `radius` meters.
+
+    Responses are cached in `places_search_cache` for `_PLACES_CACHE_TTL`, on a grid of about 100 meters
+    (with the radius rounded to `_PLACES_CACHE_RADIUS_STEP` meters), so nearby users share them.
+    """
+    key = (category.lower(), round(loc.lat * _PLACES_CACHE_SCALE), round(loc.lon * _PLACES_CACHE_SCALE), round(radius / _PLACES_CACHE_RADIUS_STEP))
+    assert isinstance(g.conn, psycopg.Connection)
+    with g.conn.cursor() as cur:
+        cur.execute("SELECT response FROM places_search_cache WHERE query = %s AND latbin = %s AND lonbin = %s AND radiusbin = %s AND expires > now();", key)
+        row = cur.fetchone()
+        if row is not None:
+            return row[0]
+        results = googlemaps.places.places(g.gmaps, query=category, location=(loc.lat, loc.lon), radius=radius)["results"]
+        cur.execute("INSERT INTO places_search_cache(query, latbin, lonbin, radiusbin, response, expires) VALUES (%s, %s, %s, %s, %s, now() + %s) "
+                    "ON CONFLICT (query, latbin, lonbin, radiusbin) DO UPDATE SET response = EXCLUDED.response, expires = EXCLUDED.expires;",
+                    key + (Jsonb(results), _PLACES_CACHE_TTL))
+        return results
+
 @bp.route("", methods=["GET"])
 @authenticate
 def get_recommendations():
@@ -16,7 +45,7 @@ def get_recommendations():
     Inputs (given as URL params):
         - `q`: the category of recommendations to search (e.g., "restaurants")
         - `lat`, `lon`: the user's coordinates, in degrees
-        - `rad` (optional): the search radius, in miles (defaults to 10, only a preference)
+        - `rad` (optional): the search radius, in miles (defaults to 10, at most about 31, only a preference)
     
     Outputs a JSON array of recommendations in the following format:
         - `name`: the name of the recommendation
@@ -40,14 +69,16 @@ def get_recommendations():
         loc = Point(lat, lon)
     except ValueError:
         abort(400)
-    radius = 16093.44
-    if "rad" in request.args:
-        try:
-            radius = float(request.args["rad"]) * 1609.344
-        except ValueError:
-            pass
+    try:
+        radius = float(request.args.get("rad", 10)) * _METERS_PER_MILE
+    except ValueError:
+        abort(400)
+    if not radius > 0:
+        abort(400)
+    # The radius is only a preference, so clamp it to the largest one Google accepts.
+    radius = min(radius, _MAX_RADIUS_METERS)
     
-    res = googlemaps.places.places(g.gmaps, query=category, location=(loc.lat, loc.lon), radius=radius)
+    results = search_places(category, loc, radius)
 
     @dataclass
     class Recommendation:
@@ -55,33 +86,29 @@ def get_recommendations():
         place: dict
         visits: int
     places = []
-    for c in res["results"]:
+    for c in results:
         places.append(Recommendation(len(places), c, 0))
+    byid = {p.place["place_id"]: p for p in places}
     with g.conn.cursor() as cur:
-        for c in places:
-            cur.execute("SELECT COUNT(*) FROM places WHERE id = %s;", (c.place["place_id"],))
-            count, = cur.fetchone()
-            if (count == 0):
-                cur.execute("INSERT INTO places(id, name, address, coords) VALUES (%s, %s, %s, %s);",
-                            (c.place["place_id"], c.place["name"], c.place["formatted_address"],
-                             Point(c.place["geometry"]["location"]["lat"], c.place["geometry"]["location"]["lng"])))
-                for t in c.place["types"]:
-                    cur.execute("INSERT INTO placetypes(id, type) VALUES (%s, %s);", (c.place["place_id"], t))
-        cur.execute("SELECT eventid FROM attendees WHERE userid = %s;", (g.userid,))
-        events = []
-        for row in cur:
-            eid, = row
-            events.append(eid)
-        cur.execute("SELECT placeid, SUM(visits) FROM locations WHERE eventid = ANY(%s) GROUP BY placeid;", (events,))
-        for row in cur:
-            pid, visits = row
-            for p in places:
-                if p.place["place_id"] == pid:
-                    p.visits = visits
-                    break
-        places.sort(key=lambda x: x.visits + x.index)
+        cur.execute("INSERT INTO places(id, name, address, coords) SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::point[]) "
+                    "ON CONFLICT (id) DO NOTHING RETURNING id;",
+                    ([c["place_id"] for c in results], [c["name"] for c in results], [c["formatted_address"] for c in results],
+                     [Point(c["geometry"]["location"]["lat"], c["geometry"]["location"]["lng"]) for c in results]))
+        # Only places inserted just now need their types recorded.
+        types = [(id, t) for id, in cur.fetchall() for t in byid[id].place["types"]]
+        if types:
+            cur.execute("INSERT INTO placetypes(id, type) SELECT * FROM unnest(%s::text[], %s::text[]);", ([id for id, _ in types], [t for _, t in types]))
+        cur.execute("SELECT placeid, SUM(visits) FROM locations WHERE placeid = ANY(%s) AND eventid IN (SELECT eventid FROM attendees WHERE userid = %s) GROUP BY placeid;",
+                    (list(byid), g.userid))
+        for pid, visits in cur:
+            byid[pid].visits = visits
+        # Most visited first; Google's own ranking breaks ties.
+        places.sort(key=lambda x: (-x.visits, x.index))
+        lats = np.array([p.place["geometry"]["location"]["lat"] for p in places], dtype=np.float64)
+        lons = np.array([p.place["geometry"]["location"]["lng"] for p in places], dtype=np.float64)
+        miles = haversine_miles(loc, lats, lons)
         ret = []
-        for p in places:
+        for p, distance in zip(places, miles.tolist()):
             ret.append({
                 "name": p.place["name"],
                 "address": p.place["formatted_address"],
@@ -89,7 +116,7 @@ def get_recommendations():
                     "lat": p.place["geometry"]["location"]["lat"],
                     "lon": p.place["geometry"]["location"]["lng"]
                 },
-                "distance": loc.distanceto(Point(p.place["geometry"]["location"]["lat"], p.place["geometry"]["location"]["lng"])).miles
+                "distance": distance
             })
         return ret
         
\ No newline at end of file
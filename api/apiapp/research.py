@@ -1,13 +1,15 @@
-from flask import request, g, Blueprint, abort
+from flask import request, g, Blueprint, abort, Response
 from .auth import authenticate
 from .location import Point
+from .event import get_query_embedding, search_conditions
 from datetime import datetime
-from openai import embeddings_utils as emb
-from typing import Any
 import psycopg
+import re
 
 bp = Blueprint("research", __name__, url_prefix="/research")
 
+_WHITESPACE_RE = re.compile(r"\s+")
+
 @bp.route("/placetypes", methods=["GET"])
 @authenticate
 def get_place_types():
@@ -23,70 +25,53 @@ def get_place_types():
             types.append(t)
         return types
 
-def get_event_name(eventid: int) -> str | None:
-    assert isinstance(g.conn, psycopg.Connection)
-    with g.conn.cursor() as cur:
-        cur.execute("SELECT displayname FROM events WHERE id = %s;", (eventid,))
-        if cur.rowcount == 0:
-            return None
-        return cur.fetchone()[0]
-
-def get_events(eventquery: str | None, startdate: datetime | None, enddate: datetime | None, eventlocation: tuple[Point, float] | None) -> list[dict[str, Any]]:
+def event_conditions(eventid: int | None, eventquery: str | None, startdate: datetime | None, enddate: datetime | None, eventlocation: tuple[Point, float] | None) -> tuple[list[str], list]:
+    """
+    Builds the SQL conditions (over `events JOIN places`) that select the events to examine, and their parameters.
+    """
     THRESHOLD = 0.85
-    assert isinstance(g.conn, psycopg.Connection)
-    with g.conn.cursor() as cur:
-        events = []
-        cur.execute("SELECT events.id, events.displayname, events.start, events.\"end\", events.embedding, places.coords FROM (events JOIN places ON events.place = places.id);")
-        for row in cur:
-            eid, ename, estart, eend, eemb, ploc = row
-            if enddate is not None and estart > enddate:
-                continue
-            if startdate is not None and eend < startdate:
-                continue
-            if eventlocation is not None:
-                coords, rad = eventlocation
-                if coords.distanceto(ploc).miles > rad:
-                    continue
-            if eventquery is not None and eventquery.strip():
-                qemb = emb.get_embedding(eventquery.strip().replace("\n", " "))
-                if emb.cosine_similarity(qemb, eemb) < THRESHOLD:
-                    continue
-            events.append({"id": eid, "displayname": ename})
-        return events
+    if eventid is not None:
+        return ["events.id = %s"], [eventid]
+    location, radius = eventlocation if eventlocation is not None else (None, float("inf"))
+    conditions, params = search_conditions(location, radius, startdate, enddate)
+    query = _WHITESPACE_RE.sub(" ", eventquery).strip() if eventquery is not None else ""
+    if query:
+        # Cosine distance is 1 - cosine similarity; events without an embedding yet never match.
+        conditions.append("events.embedding <=> %s::vector <= %s")
+        params += [get_query_embedding(query), 1 - THRESHOLD]
+    return conditions, params
 
-def get_places(events: list[dict[str, Any]], placetype: str | None, placelocation: tuple[Point, float] | None) -> list[tuple[int, str, Point]]:
-    from sys import stderr
-    if not events:
-        return []
-    assert isinstance(g.conn, psycopg.Connection)
-    with g.conn.cursor() as cur:
-        places = []
-        cur.execute("SELECT places.id, places.name, places.coords FROM (locations JOIN places ON locations.placeid = places.id) WHERE locations.eventid = ANY(%s);", (list(map(lambda x: x["id"], events)),))
-        result = cur.fetchall()
-        for row in result:
-            pid, pname, ploc = row
-            assert isinstance(ploc, Point)
-            if placelocation is not None and placelocation[0].distanceto(ploc).miles > placelocation[1]:
-                continue
-            cur.execute("SELECT type FROM placetypes WHERE id = %s;", (pid,))
-            types = [i[0] for i in cur.fetchall()]
-            if placetype is not None and placetype not in types:
-                continue
-            places.append({"id": pid, "name": pname, "coords": {"lat": ploc.lat, "lon": ploc.lon}, "types": types})
-        return places
+def place_conditions(placetype: str | None, placelocation: tuple[Point, float] | None) -> tuple[list[str], list]:
+    """
+    Builds the SQL conditions (over `places`) that select the places to examine, and their parameters.
+    """
+    location, radius = placelocation if placelocation is not None else (None, float("inf"))
+    conditions, params = search_conditions(location, radius, None, None)
+    if placetype is not None:
+        conditions.append("EXISTS(SELECT 1 FROM placetypes WHERE placetypes.id = places.id AND placetypes.type = %s)")
+        params.append(placetype)
+    return conditions, params
 
-def get_location_data(events: list[dict[str, Any]], places: list[dict[str, Any]]):
+def get_location_data(events: tuple[list[str], list], places: tuple[list[str], list]) -> str:
+    """
+    Builds the response body (see the docstring for `get_research_info()`) for the events and places matching the given conditions.
+
+    Everything, including the JSON, is built in a single query.
+    """
+    (econditions, eparams), (pconditions, pparams) = events, places
     assert isinstance(g.conn, psycopg.Connection)
     with g.conn.cursor() as cur:
-        eids = list(map(lambda x: x["id"], events))
-        pids = list(map(lambda x: x["id"], places))
-        locs = {i: {j: 0 for j in pids} for i in eids}
-        if eids and pids:
-            cur.execute("SELECT eventid, placeid, visits FROM locations WHERE eventid = ANY(%s) AND placeid = ANY(%s);", (eids, pids))
-            for row in cur:
-                eid, pid, visits = row
-                locs[eid][pid] = visits
-        return {"events": events, "places": places, "visits": locs}
+        cur.execute("WITH evs AS (SELECT events.id, events.displayname FROM (events JOIN places ON events.place = places.id) WHERE " + " AND ".join(econditions) + "), "
+                    "pls AS (SELECT places.id, places.name, places.coords, ARRAY(SELECT type FROM placetypes WHERE placetypes.id = places.id) AS types FROM places "
+                    "WHERE places.id IN (SELECT placeid FROM locations WHERE eventid IN (SELECT id FROM evs)) AND " + " AND ".join(pconditions) + ") "
+                    "SELECT json_build_object("
+                    "'events', (SELECT COALESCE(json_agg(json_build_object('id', id, 'displayname', displayname)), '[]') FROM evs), "
+                    "'places', (SELECT COALESCE(json_agg(json_build_object('id', id, 'name', name, 'coords', json_build_object('lat', coords[0], 'lon', coords[1]), 'types', types)), '[]') FROM pls), "
+                    "'visits', (SELECT COALESCE(json_object_agg(id, visits), '{}') FROM (SELECT evs.id, (SELECT COALESCE(json_object_agg(pls.id, COALESCE(locations.visits, 0)), '{}') "
+                    "FROM (pls LEFT JOIN locations ON locations.placeid = pls.id AND locations.eventid = evs.id)) AS visits FROM evs) AS v))::text;",
+                    eparams + pparams)
+        body, = cur.fetchone()
+        return body
 
 @bp.route("", methods=["GET"])
 @authenticate
@@ -120,11 +105,9 @@ def get_research_info():
     startdate = enddate = eventid = eventlocation = placelocation = None
     try:
         if "start" in request.args:
-            startdate = datetime.fromisoformat(request.args["startdate"])
+            startdate = datetime.fromisoformat(request.args["start"])
         if "end" in request.args:
-            enddate = datetime.fromisoformat(request.args["end"])
-            enddate.hour = 23
-            enddate.minute = 59
+            enddate = datetime.fromisoformat(request.args["end"]).replace(hour=23, minute=59, second=59, microsecond=999999)
         if "eventid" in request.args:
             eventid = int(request.args["eventid"])
         if "eventlat" in request.args and "eventlon" in request.args and "eventradius" in request.args:
@@ -146,12 +129,6 @@ def get_research_info():
     eventquery = request.args.get("eventquery")
     placetype = request.args.get("placetype")
     
-    eventlist = []
-    if eventid is not None:
-        name = get_event_name(eventid)
-        if name is not None:
-            eventlist.append((eventid, name))
-    else:
-        eventlist = get_events(eventquery, startdate, enddate, eventlocation)
-    placelist = get_places(eventlist, placetype, placelocation)
-    return get_location_data(eventlist, placelist)
+    events = event_conditions(eventid, eventquery, startdate, enddate, eventlocation)
+    places = place_conditions(placetype, placelocation)
+    return Response(get_location_data(events, places), mimetype="application/json")
@@ -0,0 +1,79 @@
+-- Schema changes required by the API, in the order they were introduced.
+-- Apply each statement once against the application database.
+
+-- auth.create_user relies on these to reject duplicate registrations atomically.
+ALTER TABLE users ADD CONSTRAINT users_username_key UNIQUE (username);
+ALTER TABLE users ADD CONSTRAINT users_email_key UNIQUE (email);
+
+-- event.event_add_user relies on this for INSERT ... ON CONFLICT DO NOTHING.
+CREATE UNIQUE INDEX IF NOT EXISTS attendees_userid_eventid_key ON attendees (userid, eventid);
+
+-- event.get_events_by_location filters and sorts by distance with earthdistance.
+-- Place coordinates are stored as point(lat, lon).
+CREATE EXTENSION IF NOT EXISTS cube;
+CREATE EXTENSION IF NOT EXISTS earthdistance;
+CREATE INDEX IF NOT EXISTS places_coords_earth_idx ON places USING gist (ll_to_earth(coords[0], coords[1]));
+
+-- Indexes behind the per-user and per-event lookups in event.py.
+-- attendees (userid, eventid) is already covered by attendees_userid_eventid_key.
+CREATE INDEX IF NOT EXISTS attendees_eventid_userid_idx ON attendees (eventid, userid);
+CREATE INDEX IF NOT EXISTS events_host_idx ON events (host);
+CREATE INDEX IF NOT EXISTS messages_eventid_time_idx ON messages (eventid, time DESC);
+
+-- Embeddings are computed in the background after an event is created (event.enqueue_embedding).
+ALTER TABLE events ALTER COLUMN embedding DROP NOT NULL;
+
+-- Hash of the text an event's embedding represents (event.embedding_hash), used to skip and deduplicate OpenAI calls.
+ALTER TABLE events ADD COLUMN IF NOT EXISTS embedding_hash bytea;
+CREATE INDEX IF NOT EXISTS events_embedding_hash_idx ON events (embedding_hash);
+
+-- When an event's current embedding was last queued, so the recovery sweep (event.requeue_missing_embeddings)
+-- leaves freshly queued events to the process that queued them.
+ALTER TABLE events ADD COLUMN IF NOT EXISTS embedding_requested timestamptz NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS events_embedding_requested_idx ON events (embedding_requested) WHERE embedding IS NULL;
+
+-- Embeddings are stored as pgvector vectors, so keyword search can rank events in SQL (event.get_events_by_keyword).
+CREATE EXTENSION IF NOT EXISTS vector;
+ALTER TABLE events ALTER COLUMN embedding TYPE vector(1536) USING embedding::real[]::vector;
+
+-- Embeddings of search queries, keyed by event.embedding_hash of the normalized query (event.get_query_embedding).
+CREATE TABLE IF NOT EXISTS query_embeddings (
+    hash bytea PRIMARY KEY,
+    embedding vector(1536) NOT NULL
+);
+
+-- Reverse geocoding responses on a ~1m grid of coordinates scaled by 10^5 (location.Point.reverse_geocode).
+CREATE TABLE IF NOT EXISTS reverse_geocode_cache (
+    latbin integer NOT NULL,
+    lonbin integer NOT NULL,
+    response jsonb NOT NULL,
+    expires timestamptz NOT NULL,
+    PRIMARY KEY (latbin, lonbin)
+);
+
+-- Date range filters shared by the event searches (event.search_conditions).
+CREATE INDEX IF NOT EXISTS events_start_end_idx ON events (start, "end");
+
+-- Lets location.visit_location count a visit with a single upsert.
+CREATE UNIQUE INDEX IF NOT EXISTS locations_placeid_eventid_key ON locations (placeid, eventid);
+
+-- Per-place type lookups and the type filter in research.get_places.
+CREATE INDEX IF NOT EXISTS placetypes_id_type_idx ON placetypes (id, type);
+
+-- Google Places text search responses on a ~100m grid of coordinates scaled by 10^3,
+-- with the radius in 100m steps (recommend.search_places).
+CREATE TABLE IF NOT EXISTS places_search_cache (
+    query text NOT NULL,
+    latbin integer NOT NULL,
+    lonbin integer NOT NULL,
+    radiusbin integer NOT NULL,
+    response jsonb NOT NULL,
+    expires timestamptz NOT NULL,
+    PRIMARY KEY (query, latbin, lonbin, radiusbin)
+);
+
+-- Joins behind research.get_location_data and the radius-filtered searches:
+-- places visited by a set of events, events at a set of places, and the place types list.
+CREATE INDEX IF NOT EXISTS locations_eventid_placeid_idx ON locations (eventid, placeid);
+CREATE INDEX IF NOT EXISTS events_place_idx ON events (place);
+CREATE INDEX IF NOT EXISTS placetypes_type_idx ON placetypes (type);
\ No newline at end of file